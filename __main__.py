@@ -1,52 +1,84 @@
 from typing import *
 from enum import Enum
 import asyncio
-import json
+import orjson
 import websockets
-import threading
 import signal
-import requests
+import aiohttp
+import uvloop
 import functools
-import re
+from operator import itemgetter
+import string
+from cachetools import TTLCache
+import numpy as np
 
 class Method(Enum):
     GET = 'GET'
     POST = 'POST'
 
-def bsapi_request(method: Method, prefix: str, path: str, params: dict[str, Any]) -> Optional[dict[str, Any]]:
+http_session: Optional[aiohttp.ClientSession] = None
+
+async def bsapi_request(method: Method, prefix: str, path: str, params: dict[str, Any]) -> Optional[dict[str, Any]]:
     url = f'{prefix}{path}'
-    resp = None
+    kwargs = {}
     match method:
         case Method.GET:
-            resp = requests.get(url, params=params)
+            kwargs['params'] = params
         case Method.POST:
-            resp = requests.post(url, data=params)
-    resp.encoding = 'utf-8'
-    if resp.status_code != 200:
-        return None
-    content_type = resp.headers.get('Content-Type', '')
-    return resp.json() if 'application/json' in content_type else {}
+            kwargs['data'] = params
+    async with http_session.request(method.value, url, **kwargs) as resp:
+        if resp.status != 200:
+            return None
+        content_type = resp.headers.get('Content-Type', '')
+        return await resp.json(loads=orjson.loads, content_type=None) if 'application/json' in content_type else {}
+
+def _path_formatter(path: str) -> Callable[..., str]:
+    parts = list(string.Formatter().parse(path))
+    match [(name, spec, conv) for _, name, spec, conv in parts if name is not None]:
+        case []:
+            literal = path.format()
+            return lambda **kwargs: literal
+        case [('id', '', None)]:
+            pos = next(i for i, e in enumerate(parts) if e[1] is not None) + 1
+            head = ''.join(e[0] for e in parts[:pos])
+            tail = ''.join(e[0] for e in parts[pos:])
+            return lambda **kwargs: f'{head}{kwargs["id"]}{tail}'
+        case _:
+            return lambda **kwargs: path.format(**kwargs)
 
 def bsapi(path: str, method: Method):
+    format_path = _path_formatter(path)
     def decorator(func: Callable):
         @functools.wraps(func)
-        def wrapper(*args, **kwargs) -> Optional[dict[str, Any]]:
-            params = {
-                **(func(*args, **kwargs) or {})
-            }
-            return bsapi_request(method, 'https://api.beatleader.com', path.format(**kwargs), params)
+        async def wrapper(*args, **kwargs) -> Optional[dict[str, Any]]:
+            params = func(*args, **kwargs) or {}
+            return await bsapi_request(method, 'https://api.beatleader.com', format_path(**kwargs), params)
         return wrapper
     return decorator
 
-class BSAPI:
-    @bsapi('/player/{id}', Method.GET)
-    def _exists(id: str):
-        pass
+def cached(ttl: float, maxsize: int = 1024):
+    def decorator(func: Callable):
+        cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (args, frozenset(kwargs.items()))
+            if key in cache:
+                return cache[key]
+            result = await func(*args, **kwargs)
+            if result is not None:
+                cache[key] = result
+            return result
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
 
+class BSAPI:
+    @cached(ttl=300)
     @bsapi('/players', Method.GET)
     def players(**kwargs):
         return kwargs
 
+    @cached(ttl=60)
     @bsapi('/player/{id}', Method.GET)
     def player(id: str):
         pass
@@ -55,9 +87,6 @@ class BSAPI:
     def accgraph(id: str, **kwargs):
         return kwargs
 
-    def exists(id: str) -> bool:
-        return BSAPI._exists(id=id) is not None
-
 class RawCommand(NamedTuple):
     sender: int
     command: str
@@ -66,11 +95,18 @@ class RawCommand(NamedTuple):
 class Command(NamedTuple):
     group: Optional[int]
     sender: int
-    command: list[str]
+    handler: Callable
+    args: list[str]
     targets: set[int]
 
 class BeatSaberQuery:
     PREFIX: str = '\\'
+    _PREFIX_LEN: int = len(PREFIX)
+    FLUSH_INTERVAL: float = 0.05
+    MAX_BATCH_BYTES: int = 2048
+    MAX_PENDING_COMMANDS: int = 256
+    RECONNECT_DELAY_MIN: float = 1
+    RECONNECT_DELAY_MAX: float = 60
 
     available_commands: set[str]
     router: dict[str, Callable]
@@ -78,33 +114,35 @@ class BeatSaberQuery:
     private_enabled: set[int]
 
     _task_queue: asyncio.Queue[Command]
+    _outbox: dict[tuple[str, int], list[str]]
     _ws_server_addr: str
     _ws_server_port: int
     _http_server_addr: str
     _http_server_port: int
-    _cancelled: threading.Event
+    _cancelled: asyncio.Event
 
     def __init__(self):
         self.available_commands = set()
         self.router = {}
         self.group_enabled = set()
         self.private_enabled = set()
-        self._task_queue = asyncio.Queue()
+        self._task_queue = asyncio.Queue(maxsize=BeatSaberQuery.MAX_PENDING_COMMANDS)
+        self._outbox = {}
         self._ws_server_addr = 'localhost'
         self._ws_server_port = 3001
         self._http_server_addr = 'localhost'
         self._http_server_port = 3000
-        self._cancelled = threading.Event()
+        self._cancelled = asyncio.Event()
 
     def command(self, subcmd: str):
         def decorator(func: Callable):
             @functools.wraps(func)
-            def wrapper(*args, **kwargs):
-                reply: Optional[str] = func(*args, **kwargs)
+            async def wrapper(*args, **kwargs):
+                reply: Optional[str] = await func(*args, **kwargs)
                 private = kwargs.get('sender')
                 group = kwargs.get('group')
                 if reply and (private or group):
-                    self.reply(reply, group=group, private=private)
+                    await self.reply(reply, group=group, private=private)
             self.available_commands.add(subcmd)
             self.router[subcmd] = wrapper
         return decorator
@@ -116,35 +154,36 @@ class BeatSaberQuery:
         return await self._task_queue.get()
 
     def parse(self, text: str) -> Optional[list[str]]:
-        argv = list(map(str.strip, filter(lambda e: e, text.split(' '))))
-        if len(argv) == 0:
-            return None
-        if not argv[0].startswith(BeatSaberQuery.PREFIX):
+        argv = text.split()
+        if not argv or not argv[0].startswith(BeatSaberQuery.PREFIX):
             return None
-        argv[0] = argv[0][len(BeatSaberQuery.PREFIX):]
-        cmd = argv[0]
-        if not cmd in self.available_commands:
-            return None
-        return argv
+        cmd = argv[0] = argv[0][BeatSaberQuery._PREFIX_LEN:]
+        return argv if cmd in self.available_commands else None
 
-    def query(self, cmd: Command):
-        self.router[cmd.command[0]](*cmd.command[1:], sender=cmd.sender, targets=cmd.targets, group=cmd.group)
+    async def query(self, cmd: Command):
+        await cmd.handler(*cmd.args, sender=cmd.sender, targets=cmd.targets, group=cmd.group)
 
     def translate(self, msg: dict[str, Any]) -> Optional[RawCommand]:
-        allowd_type = ['at', 'text']
-        if len(list(filter(lambda e: e not in allowd_type, map(lambda e: e['type'], msg['message'])))) != 0:
-            return None
-        sender = msg['user_id']
-        command = ''.join(map(lambda e: e['data']['text'] if e['type'] == 'text' else ' ', msg['message']))
-        targets = set(map(lambda e: e['data']['qq'], filter(lambda e: e['data']['qq'] != 'all', filter(lambda e: e['type'] == 'at', msg['message']))))
-        return RawCommand(sender, command, targets)
+        parts: list[str] = []
+        targets: set[int] = set()
+        for e in msg['message']:
+            match e['type']:
+                case 'text':
+                    parts.append(e['data']['text'])
+                case 'at':
+                    parts.append(' ')
+                    if (qq := e['data']['qq']) != 'all':
+                        targets.add(qq)
+                case _:
+                    return None
+        return RawCommand(msg['user_id'], ''.join(parts), targets)
 
     async def message_poller(self, addr: str, port: int):
-        async with websockets.connect(f'ws://{addr}:{port}') as ws:
+        async with websockets.connect(f'ws://{addr}:{port}', compression=None, max_size=2**22, max_queue=256, close_timeout=1) as ws:
             while not self._cancelled.is_set():
                 data = await ws.recv()
                 try:
-                    msg: dict[str, Any] = json.loads(data)
+                    msg: dict[str, Any] = orjson.loads(data)
                 except:
                     continue
                 enabled = False
@@ -159,32 +198,72 @@ class BeatSaberQuery:
                 if not opt_raw:
                     continue
                 raw: RawCommand = opt_raw
-                if command := self.parse(opt_raw.command):
+                if argv := self.parse(opt_raw.command):
                     group = msg.get('group_id')
-                    await self.enqueue(Command(group, raw.sender, command, raw.targets))
+                    handler = self.router[argv[0]]
+                    await self.enqueue(Command(group, raw.sender, handler, argv[1:], raw.targets))
+
+    async def poll_with_reconnect(self, addr: str, port: int):
+        loop = asyncio.get_running_loop()
+        delay = BeatSaberQuery.RECONNECT_DELAY_MIN
+        while not self._cancelled.is_set():
+            started = loop.time()
+            try:
+                await self.message_poller(addr, port)
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                pass
+            if loop.time() - started > BeatSaberQuery.RECONNECT_DELAY_MAX:
+                delay = BeatSaberQuery.RECONNECT_DELAY_MIN
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BeatSaberQuery.RECONNECT_DELAY_MAX)
 
     async def message_handler(self):
         while not self._cancelled.is_set():
             task = await self.dequeue()
-            self.query(task)
+            await self.query(task)
 
-    def reply(self, msg: str, **kwargs):
+    async def reply(self, msg: str, **kwargs):
         group: Optional[int] = kwargs.get('group')
         private: Optional[int] = kwargs.get('private')
         if group:
-            api = f'http://{self._http_server_addr}:{self._http_server_port}/send_group_msg'
-            data = {
-                'group_id': group,
-                'message': f'[CQ:at,qq={private}] {msg}',
-            }
+            key = ('group', group)
+            msg = f'[CQ:at,qq={private}] {msg}'
         elif private:
-            api = f'http://{self._http_server_addr}:{self._http_server_port}/send_private_msg'
-            data = {
-                'user_id': private,
-                'message': msg,
-            }
-        if api and data:
-            requests.post(api, json=data)
+            key = ('private', private)
+        else:
+            return
+        pending = self._outbox.setdefault(key, [])
+        pending.append(msg)
+        if sum(len(e.encode()) for e in pending) >= BeatSaberQuery.MAX_BATCH_BYTES:
+            del self._outbox[key]
+            await self.send(*key, '\n'.join(pending))
+
+    async def send(self, kind: str, target: int, msg: str):
+        match kind:
+            case 'group':
+                api = f'http://{self._http_server_addr}:{self._http_server_port}/send_group_msg'
+                data = {
+                    'group_id': target,
+                    'message': msg,
+                }
+            case 'private':
+                api = f'http://{self._http_server_addr}:{self._http_server_port}/send_private_msg'
+                data = {
+                    'user_id': target,
+                    'message': msg,
+                }
+        async with http_session.post(api, data=orjson.dumps(data), headers={'Content-Type': 'application/json'}):
+            pass
+
+    async def flush(self):
+        outbox, self._outbox = self._outbox, {}
+        for (kind, target), pending in outbox.items():
+            await self.send(kind, target, '\n'.join(pending))
+
+    async def flush_loop(self):
+        while not self._cancelled.is_set():
+            await asyncio.sleep(BeatSaberQuery.FLUSH_INTERVAL)
+            await self.flush()
 
     def listen(self, addr: str, port: int):
         self._ws_server_addr = addr
@@ -195,17 +274,25 @@ class BeatSaberQuery:
         self._http_server_port = port
 
     def exec(self):
-        def cancel(signum, frame):
-            self._cancelled.set()
-        signal.signal(signal.SIGINT, cancel)
-        signal.signal(signal.SIGTERM, cancel)
         async def main():
-            try:
-                producer = self.message_poller(self._ws_server_addr, self._ws_server_port)
-                consumer = self.message_handler()
-                await asyncio.gather(producer, consumer)
-            except asyncio.CancelledError:
-                pass
+            global http_session
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGINT, self._cancelled.set)
+            loop.add_signal_handler(signal.SIGTERM, self._cancelled.set)
+            connector = aiohttp.TCPConnector(limit=32, keepalive_timeout=60)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                http_session = session
+                async with asyncio.TaskGroup() as tg:
+                    tasks = [
+                        tg.create_task(self.poll_with_reconnect(self._ws_server_addr, self._ws_server_port)),
+                        tg.create_task(self.message_handler()),
+                        tg.create_task(self.flush_loop()),
+                    ]
+                    await self._cancelled.wait()
+                    for task in tasks:
+                        task.cancel()
+                await self.flush()
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
         asyncio.run(main())
 
 bs = BeatSaberQuery()
@@ -215,7 +302,7 @@ bs.private_enabled.add(1745096608)
 bindings: dict[int, int] = {}
 
 @bs.command('help')
-def display_help(*args, **kwargs):
+async def display_help(*args, **kwargs):
     commands = {
         'help': f'显示帮助信息，输入 {bs.PREFIX}help <命令> 显示详细信息',
         'me': '查询或关联我的 BL 账号',
@@ -228,8 +315,9 @@ def display_help(*args, **kwargs):
     return '当前可用命令\n' + '\n'.join(f'{bs.PREFIX}{cmd} - {brief}' for cmd, brief in commands.items())
 
 @bs.command('me')
-def query_me(*args, **kwargs):
+async def query_me(*args, **kwargs):
     opt_uid: Optional[str] = None
+    profile: Optional[dict[str, Any]] = None
     sender = kwargs['sender']
     already_bind = sender in bindings
     if len(args) == 0:
@@ -237,24 +325,25 @@ def query_me(*args, **kwargs):
             return f'账号暂未关联，请输入 {bs.PREFIX}help 查询帮助信息'
         opt_uid = bindings[sender]
     elif (uid := args[0]).isdigit():
-        if not BSAPI.exists(id=uid):
+        if not (profile := await BSAPI.player(id=uid)):
             return '非法 UID'
         opt_uid = uid
     else:
         kw = ' '.join(args)
         if len(kw) < 3:
             return '搜索关键字过短'
-        results = BSAPI.players(search=kw, countries='cn', count=5)
+        results = await BSAPI.players(search=kw, countries='cn', count=5)
         if not results:
             return '搜索失败，请稍后再试'
         results = results['data']
         if len(results) == 0:
             return '搜索结果为空，请检查关键字'
         if len(results) > 1:
-            candidates = map(lambda e: f"[{e['country']}] {e['name']} / {e['pp']}pp ({e['id']})", results)
-            return f'已找到以下候选结果\n' + '\n'.join(map(lambda e: f'{e[0]+1:02d}. {e[1]}', enumerate(candidates)))
+            candidates = (f"{i:02d}. [{e['country']}] {e['name']} / {e['pp']}pp ({e['id']})" for i, e in enumerate(results, 1))
+            return f'已找到以下候选结果\n' + '\n'.join(candidates)
         opt_uid = results[0]['id']
-    profile = BSAPI.player(id=opt_uid)
+    if not profile:
+        profile = await BSAPI.player(id=opt_uid)
     if not profile:
         if already_bind:
             return f'已检索到 UID {opt_uid}，资料获取失败'
@@ -275,8 +364,25 @@ def query_me(*args, **kwargs):
     msg.append(f'[{country}][{platform}] {name} {pp:.2f}pp 国区 {country_rank} 全球 {rank}')
     return '\n'.join(msg)
 
+def _parse_pp(tok: str) -> Optional[float]:
+    if not tok.endswith('pp') or not (num := tok[:-2]).replace('.', '', 1).isdecimal():
+        return None
+    return float(num)
+
+def _parse_rank_token(tok: str, cur_rank: int, cur_pp: float) -> Optional[tuple[str, Optional[int], Optional[float]]]:
+    if tok.isdecimal():
+        return 'rank', int(tok), None
+    if tok.startswith(('+', '-')) and tok[1:].isdecimal():
+        rank = cur_rank - int(tok)
+        return 'rank' if rank <= cur_rank else 'rank-reverse', rank, None
+    if (pp := _parse_pp(tok)) is not None:
+        return 'pp', None, pp
+    if tok.startswith('+') and (pp := _parse_pp(tok[1:])) is not None:
+        return 'pp', None, cur_pp + pp
+    return None
+
 @bs.command('rkup')
-def query_rank_up(*args, **kwargs):
+async def query_rank_up(*args, **kwargs):
     uid = bindings.get(kwargs['sender'])
     if not uid:
         return f'账号暂未关联，请输入 {bs.PREFIX}help 查询帮助信息'
@@ -287,15 +393,16 @@ def query_rank_up(*args, **kwargs):
     nr: Optional[int] = None
     pp_each: Optional[float] = None
 
-    if profile := BSAPI.player(id=uid):
+    if profile := await BSAPI.player(id=uid):
         country = profile['country']
         cur_rank = profile['countryRank']
         cur_pp = profile['pp']
     else:
         return '资料获取失败，请稍后再试'
 
-    if accgraph := BSAPI.accgraph(id=uid, leaderboardContext='general', type='weight', no_unranked_stars=''):
-        pp_list = sorted(map(lambda e: e['pp'], accgraph), reverse=True)
+    if accgraph := await BSAPI.accgraph(id=uid, leaderboardContext='general', type='weight', no_unranked_stars=''):
+        pp_list = np.fromiter(map(itemgetter('pp'), accgraph), dtype=np.float64, count=len(accgraph))
+        pp_list[::-1].sort()
     else:
         return 'PP 列表获取失败，请稍后再试'
 
@@ -305,31 +412,16 @@ def query_rank_up(*args, **kwargs):
         mode = 'rank'
 
     if len(args) >= 1:
-        if args[0].isdigit():
-            nr = 1
-            rank = int(args[0])
-            mode = 'rank'
-        elif re.compile(r'[+-]\d+').fullmatch(args[0]):
+        if token := _parse_rank_token(args[0], cur_rank, cur_pp):
             nr = 1
-            rank = cur_rank - int(args[0])
-            mode = 'rank' if rank <= cur_rank else 'rank-reverse'
-        elif re.compile(r'(\d+(\.\d*)?|\.\d+)pp').fullmatch(args[0]):
-            nr = 1
-            pp = float(args[0][:-2])
-            mode = 'pp'
-        elif re.compile(r'\+(\d+(\.\d*)?|\.\d+)pp').fullmatch(args[0]):
-            nr = 1
-            pp = cur_pp + float(args[0][:-2])
-            mode = 'pp'
+            mode, rank, pp = token
         else:
             return f'非法的输入 "{args[0]}"，请输入 {bs.PREFIX}help 查询帮助信息'
 
     if len(args) >= 2:
-        if args[1].isdigit():
+        if args[1].isdecimal():
             nr = int(args[1])
-        elif re.compile(r'(\d+(\.\d*)?|\.\d+)pp').fullmatch(args[0]):
-            pp_each = float(args[1][:-2])
-        else:
+        elif (pp_each := _parse_pp(args[1])) is None:
             return f'非法的输入 "{args[1]}"，请输入 {bs.PREFIX}help 查询帮助信息'
 
     if rank is not None and rank == cur_rank:
@@ -344,14 +436,6 @@ def query_rank_up(*args, **kwargs):
     if nr is not None and nr == 0 and mode != 'rank-reverse':
         return f'摆烂是无法上分的，你总得打一首歌'
 
-    if resp := BSAPI.players(countries=country, order='asc', count=1, sortBy='pp'):
-        total_players = resp['metadata']['total']
-    else:
-        return f'获取国区 {country} 的玩家信息失败'
-
-    if mode == 'rank-reverse' and rank > total_players:
-        return f'国区排名 {rank} 的玩家还没有出生'
-
     target_rank: Optional[int] = None
     target_name: Optional[str] = None
     target_pp: Optional[float] = None
@@ -359,13 +443,15 @@ def query_rank_up(*args, **kwargs):
     if mode == 'rank' or mode == 'rank-reverse':
         target_rank = max(1, rank)
         per_page = 10
-        if resp := BSAPI.players(countries=country, order='desc', count=per_page, page=(target_rank - 1) // per_page + 1, sortBy='pp'):
-            player = resp['data'][target_rank % per_page - 1]
-            target_name = player['name']
-            target_pp = player['pp']
-            target_global_rank = player['rank']
-        else:
+        if not (resp := await BSAPI.players(countries=country, order='desc', count=per_page, page=(target_rank - 1) // per_page + 1, sortBy='pp')):
             return f'获取国区排名 {rank} 的玩家信息失败'
+        total_players = resp['metadata']['total']
+        if mode == 'rank-reverse' and rank > total_players:
+            return f'国区排名 {rank} 的玩家还没有出生'
+        player = resp['data'][target_rank % per_page - 1]
+        target_name = player['name']
+        target_pp = player['pp']
+        target_global_rank = player['rank']
 
     # TODO: impl
 